@@ -0,0 +1,176 @@
+"""
+Numba kernels shared by the STEP1 SAR scripts.
+
+Each kernel fuses what used to be several full-raster numpy passes (boolean
+indexing, masked-array arithmetic) into a single loop over the pixels.
+All kernels are cached on disk (cache=True), so only the very first run compiles;
+warmup_average_worker() loads the ones the averaging pool workers use before any
+real work is dispatched. Kernels stay lazily compiled (no eager signatures): loading
+a parallel kernel starts numba's threading layer, which must not happen in the parent
+before the process pool forks.
+
+Requires:
+  pip install numba
+"""
+import numpy as np
+from numba import njit, prange
+
+EPS = 1e-12  # protect division by ~zero
+LOG2_10_OVER_10 = 0.33219280948873626  # 10**(x/10) == 2**(x * log2(10)/10)
+
+# No fastmath here: reassociation would optimize the Kahan compensation away.
+@njit(parallel=True, cache=True)
+def accumulate(sum_f32, comp_f32, cnt_u32, data_f32, valid_u8):
+    """
+    Add the pixels of one scene that are valid (valid_u8 set) and finite into the
+    running sum/count (in place), so callers need no separate isfinite pass.
+    The float32 sum is Kahan-compensated through comp_f32.
+    """
+    h, w = data_f32.shape
+    zero = np.float32(0.0)
+    for i in prange(h):
+        for j in range(w):
+            # Branchless: skipped pixels add 0 (a select, not data * ok, since data may be NaN there)
+            d = data_f32[i, j]
+            ok = (valid_u8[i, j] != 0) & np.isfinite(d)
+            x = d if ok else zero
+            y = x - comp_f32[i, j]
+            t = sum_f32[i, j] + y
+            comp_f32[i, j] = (t - sum_f32[i, j]) - y
+            sum_f32[i, j] = t
+            cnt_u32[i, j] += np.uint32(ok)
+
+@njit(cache=True)
+def _rbr_px(b, a):
+    """RBR of one pixel; NaN where a + b <= EPS or the ratio is not finite."""
+    den = a + b
+    r = (a - b) / (den + EPS)
+    if den <= EPS or not np.isfinite(r):
+        return np.nan
+    return r
+
+# No fastmath in the RBR kernels: the NaN/Inf guard relies on IEEE semantics.
+@njit(parallel=True, cache=True)
+def rbr_kernel(b, a, mask_out):
+    """
+    RBR = (a - b) / (a + b + EPS) per pixel.
+    mask_out holds the input mask (1 = invalid) and is updated in place where
+    a + b <= EPS or the ratio is not finite. Returns the float32 ratio.
+    """
+    h, w = b.shape
+    out = np.empty((h, w), dtype=np.float32)
+    for i in prange(h):
+        for j in range(w):
+            r = np.nan if mask_out[i, j] else _rbr_px(b[i, j], a[i, j])
+            if np.isnan(r):
+                mask_out[i, j] = 1
+            out[i, j] = r
+    return out
+
+@njit(fastmath={"afn", "contract"}, cache=True)
+def _db_to_linear(x):
+    """dB -> linear power as exp2, which LLVM can vectorize (unlike libm pow)."""
+    return np.exp2(x * LOG2_10_OVER_10)
+
+# Only the NaN-safe fastmath flags (approximate functions, FMA contraction).
+@njit(parallel=True, fastmath={"afn", "contract"}, cache=True)
+def rbr_fused_db_to_linear(b_db, a_db, mask_out):
+    """
+    As rbr_kernel, but for inputs in dB: the dB -> linear conversion
+    happens in the same pass, without linear temporaries.
+    """
+    h, w = b_db.shape
+    out = np.empty((h, w), dtype=np.float32)
+    for i in prange(h):
+        for j in range(w):
+            if mask_out[i, j]:
+                r = np.nan
+            else:
+                r = _rbr_px(_db_to_linear(b_db[i, j]), _db_to_linear(a_db[i, j]))
+            if np.isnan(r):
+                mask_out[i, j] = 1
+            out[i, j] = r
+    return out
+
+@njit(parallel=True, cache=True)
+def interp_control_grid(grid_r, grid_c, h, w):
+    """
+    Bilinearly interpolate an n x n control grid of source (row, col) positions,
+    evaluated at evenly spaced output pixels, to every pixel of an h x w window.
+    """
+    n = grid_r.shape[0]
+    out_r = np.empty((h, w), dtype=np.float64)
+    out_c = np.empty((h, w), dtype=np.float64)
+    su = (n - 1) / (h - 1) if h > 1 else 0.0
+    sv = (n - 1) / (w - 1) if w > 1 else 0.0
+    for i in prange(h):
+        u = i * su
+        k = min(int(u), n - 2)
+        fu = u - k
+        for j in range(w):
+            v = j * sv
+            l = min(int(v), n - 2)
+            fv = v - l
+            w00 = (1.0 - fu) * (1.0 - fv)
+            w10 = fu * (1.0 - fv)
+            w01 = (1.0 - fu) * fv
+            w11 = fu * fv
+            out_r[i, j] = (grid_r[k, l] * w00 + grid_r[k + 1, l] * w10
+                           + grid_r[k, l + 1] * w01 + grid_r[k + 1, l + 1] * w11)
+            out_c[i, j] = (grid_c[k, l] * w00 + grid_c[k + 1, l] * w10
+                           + grid_c[k, l + 1] * w01 + grid_c[k + 1, l + 1] * w11)
+    return out_r, out_c
+
+@njit(parallel=True, cache=True)
+def bilinear_sample(src, src_valid, src_r, src_c, row_off, col_off, src_h, src_w, out, out_valid):
+    """
+    Bilinear sampling of src at pixel-centre coordinates (src_r, src_c).
+    src is a window of a src_h x src_w raster starting at (row_off, col_off).
+    Invalid neighbours are dropped and the remaining weights renormalized;
+    points outside the source extent stay invalid. Writes out/out_valid in place.
+    """
+    h, w = out.shape
+    sh, sw = src.shape
+    for i in prange(h):
+        for j in range(w):
+            out[i, j] = np.nan
+            out_valid[i, j] = 0
+            r = src_r[i, j]
+            c = src_c[i, j]
+            # also rejects NaN coordinates
+            if not (r >= -0.5 and r <= src_h - 0.5 and c >= -0.5 and c <= src_w - 0.5):
+                continue
+            r0 = int(np.floor(r))
+            c0 = int(np.floor(c))
+            fr = r - r0
+            fc = c - c0
+            acc = 0.0
+            wsum = 0.0
+            for di in range(2):
+                ii = r0 + di - row_off
+                if ii < 0 or ii >= sh:
+                    continue
+                wr = fr if di else 1.0 - fr
+                for dj in range(2):
+                    jj = c0 + dj - col_off
+                    if jj < 0 or jj >= sw or not src_valid[ii, jj]:
+                        continue
+                    wt = wr * (fc if dj else 1.0 - fc)
+                    acc += wt * src[ii, jj]
+                    wsum += wt
+            if wsum > 0.0:
+                out[i, j] = acc / wsum
+                out_valid[i, j] = 1
+
+def warmup_average_worker():
+    """
+    Call the kernels an averaging worker runs (accumulate, interp_control_grid,
+    bilinear_sample) once on 1x1 inputs, so their compiled code is loaded up front.
+    """
+    f = np.ones((1, 1), dtype=np.float32)
+    accumulate(np.zeros((1, 1), dtype=np.float32), np.zeros((1, 1), dtype=np.float32),
+               np.zeros((1, 1), dtype=np.uint32), f, np.zeros((1, 1), dtype=np.uint8))
+    g = np.zeros((2, 2), dtype=np.float64)
+    r, c = interp_control_grid(g, g, 1, 1)
+    bilinear_sample(f, np.ones((1, 1), dtype=np.uint8), r, c, 0, 0, 1, 1,
+                    np.empty((1, 1), dtype=np.float32), np.empty((1, 1), dtype=np.uint8))
@@ -0,0 +1,81 @@
+"""
+Approximate reprojection onto a reference grid (bilinear, NoData-aware).
+
+The exact ref->source transform is evaluated only on a CONTROL_GRID x CONTROL_GRID
+lattice of output pixel centres per window; every other pixel gets its source
+position by bilinear interpolation of that lattice (numba), followed by a numba
+bilinear resampler. For the small extents of S1 GRD stacks the approximation
+error stays well below the 0.5 px tolerance, so no per-scanline error check is done.
+"""
+import math
+
+import numpy as np
+from rasterio.warp import transform
+from rasterio.windows import Window
+
+from _kernels import bilinear_sample, interp_control_grid
+
+CONTROL_GRID = 17
+WINDOW_SIZE = 512
+
+def iter_windows(ref, size=WINDOW_SIZE, region=None):
+    """Yield size x size windows tiling the reference grid (or only its region Window)."""
+    if region is None:
+        r0, c0, r1, c1 = 0, 0, ref["height"], ref["width"]
+    else:
+        r0, c0 = int(region.row_off), int(region.col_off)
+        r1, c1 = r0 + int(region.height), c0 + int(region.width)
+    for row_off in range(r0, r1, size):
+        for col_off in range(c0, c1, size):
+            yield Window(col_off, row_off, min(size, c1 - col_off), min(size, r1 - row_off))
+
+def reproject_window(ds, band_index, ref, window):
+    """
+    Resample band of ds onto one window of the reference grid (scale/offset applied).
+    Returns (data_float32, valid_uint8) shaped like the window.
+    """
+    h, w = int(window.height), int(window.width)
+    out = np.full((h, w), np.nan, dtype="float32")
+    out_valid = np.zeros((h, w), dtype="uint8")
+
+    # Exact transform on the control lattice of output pixel centres
+    rows = window.row_off + 0.5 + np.linspace(0, h - 1, CONTROL_GRID)
+    cols = window.col_off + 0.5 + np.linspace(0, w - 1, CONTROL_GRID)
+    cc, rr = np.meshgrid(cols, rows)
+    xs, ys = ref["transform"] * (cc, rr)
+    if ds.crs != ref["crs"]:
+        xs, ys = transform(ref["crs"], ds.crs, xs.ravel(), ys.ravel())
+        xs = np.asarray(xs).reshape(cc.shape)
+        ys = np.asarray(ys).reshape(cc.shape)
+    src_cols, src_rows = ~ds.transform * (xs, ys)
+    grid_r = np.asarray(src_rows, dtype="float64") - 0.5
+    grid_c = np.asarray(src_cols, dtype="float64") - 0.5
+
+    finite = np.isfinite(grid_r) & np.isfinite(grid_c)
+    if not finite.any():
+        return out, out_valid
+
+    # Source window covering the footprint (+1 px for the bilinear neighbours);
+    # bilinear interpolation never leaves the control lattice's bounding box.
+    r0 = max(math.floor(grid_r[finite].min()) - 1, 0)
+    r1 = min(math.ceil(grid_r[finite].max()) + 2, ds.height)
+    c0 = max(math.floor(grid_c[finite].min()) - 1, 0)
+    c1 = min(math.ceil(grid_c[finite].max()) + 2, ds.width)
+    if r0 >= r1 or c0 >= c1:
+        return out, out_valid
+
+    src = ds.read(band_index, window=Window(c0, r0, c1 - c0, r1 - r0), masked=False).astype("float32")
+    src_valid = np.isfinite(src)
+    nd = ds.nodata
+    if nd is not None and not math.isnan(nd):
+        src_valid &= (src != nd)
+    # Packed (e.g. int16) inputs: NoData is tested on the raw values, then unpacked
+    scale, offset = ds.scales[band_index - 1], ds.offsets[band_index - 1]
+    if scale != 1.0 or offset != 0.0:
+        src *= np.float32(scale)
+        src += np.float32(offset)
+
+    src_r, src_c = interp_control_grid(grid_r, grid_c, h, w)
+    bilinear_sample(src, src_valid.view(np.uint8), src_r, src_c, r0, c0,
+                    ds.height, ds.width, out, out_valid)
+    return out, out_valid
@@ -0,0 +1,105 @@
+"""
+Helpers shared by the STEP1 SAR scripts.
+"""
+import os
+from pathlib import Path
+
+import rasterio
+
+# GDAL defaults for all STEP1 scripts: multithreaded decode, a bigger block cache and
+# no PROJ network/inverse-check lookups per transform. Sidecar discovery on open is
+# left on: band names (.aux.xml) and external overviews (.ovr) live there.
+# Values already set in the environment win.
+GDAL_ENV = {
+    "GDAL_NUM_THREADS": "ALL_CPUS",
+    "GDAL_CACHEMAX": "2048",
+    "PROJ_NETWORK": "OFF",
+    "CHECK_WITH_INVERT_PROJ": "NO",
+}
+for _k, _v in GDAL_ENV.items():
+    os.environ.setdefault(_k, _v)
+
+def gdal_env():
+    """Effective GDAL options (environment overrides the defaults), for rasterio.Env(**...)."""
+    # rasterio.Env wants numeric options (e.g. GDAL_CACHEMAX) as ints
+    return {k: int(v) if v.isdigit() else v for k, v in ((k, os.environ[k]) for k in GDAL_ENV)}
+
+_WORKER_ENV = None
+
+def init_worker_env(n_workers=1):
+    """
+    Pool initializer: enter one rasterio.Env for the lifetime of the worker process.
+    The pool already keeps every core busy, so each worker decodes single-threaded
+    and gets its share of the block cache.
+    """
+    global _WORKER_ENV
+    if _WORKER_ENV is None:
+        env = gdal_env()
+        env["GDAL_NUM_THREADS"] = 1
+        if isinstance(env["GDAL_CACHEMAX"], int):
+            env["GDAL_CACHEMAX"] = max(64, env["GDAL_CACHEMAX"] // n_workers)
+        _WORKER_ENV = rasterio.Env(**env)
+        _WORKER_ENV.__enter__()
+
+TIFF_EXTS = (".tif", ".tiff")
+
+def list_tiffs(root: Path, recursive: bool):
+    """
+    Sorted GeoTIFF paths under root (case-insensitive extension), in one directory pass.
+    A missing root (or a file) gives [], with or without recursion.
+    """
+    if not os.path.isdir(root):
+        return []
+    if recursive:
+        walker = os.walk(root)
+    else:
+        with os.scandir(root) as it:
+            walker = [(str(root), [], [e.name for e in it if e.is_file()])]
+    return sorted(Path(d) / n for d, _, names in walker for n in names
+                  if n.lower().endswith(TIFF_EXTS))
+
+def find_vv_vh_indices(ds, filepath: Path):
+    """
+    Return {'VV': idx_or_None, 'VH': idx_or_None} (1-based band indices).
+    Priority: per-band descriptions/tags -> filename hint -> fallback [1,2].
+    """
+    vv = None
+    vh = None
+
+    # descriptions
+    if ds.descriptions:
+        for i, d in enumerate(ds.descriptions, start=1):
+            if not d:
+                continue
+            t = d.strip().upper()
+            if t == "VV" and vv is None:
+                vv = i
+            if t == "VH" and vh is None:
+                vh = i
+
+    # tags (one GDAL metadata read per band)
+    for i in range(1, ds.count + 1):
+        tags = ds.tags(i)
+        for k in ("BAND_NAME", "name", "band_name", "long_name"):
+            v = tags.get(k)
+            if not v:
+                continue
+            t = v.strip().upper()
+            if t == "VV" and vv is None:
+                vv = i
+            if t == "VH" and vh is None:
+                vh = i
+
+    # filename hint for single-band
+    name = filepath.name.upper()
+    if ds.count == 1:
+        if "VV" in name and vv is None:
+            vv = 1
+        if "VH" in name and vh is None:
+            vh = 1
+
+    # fallback by position for 2-band products (many stacks are [VV, VH])
+    if ds.count >= 2 and vv is None and vh is None:
+        vv, vh = 1, 2
+
+    return {"VV": vv, "VH": vh}
@@ -7,39 +7,52 @@ Average Sentinel-1 VV/VH before/after a threshold date.
 
 Outputs (in --outdir):
   VV_before.tiff, VH_before.tiff, VV_after.tiff, VH_after.tiff
+  float32 by default; --out-dtype int16 stores value / 0.01 as int16 with the scale/offset
+  in the GeoTIFF (half the size, 0.01 steps: meant for dB data, too coarse for linear power).
 
 Usage examples:
   python s1_avg_before_after.py "s1_grd_VV-VH"
   python s1_avg_before_after.py "s1_grd_VV-VH" --recursive --outdir "s1_averages"
+  python s1_avg_before_after.py "s1_grd_VV-VH_db" --out-dtype int16
 
 Notes:
 - Averages are done in the **native units** of the GeoTIFFs. If your files are in linear γ0,
   this is the correct way to average. If they’re already in dB, consider averaging in linear
   by converting to linear first; or add a flag to average in dB if you really need that.
+
+Requires:
+  pip install rasterio numpy numba
 """
 
 import argparse
 import math
+import os
 import re
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import date
+from itertools import islice
 from pathlib import Path
 
+import numba
 import numpy as np
 import rasterio
-from rasterio.warp import reproject, Resampling
+
+from _kernels import accumulate, warmup_average_worker
+from _reproject import iter_windows, reproject_window
+from _s1_utils import find_vv_vh_indices, gdal_env, init_worker_env, list_tiffs
 
 THRESHOLD = date(2023, 7, 18)
 NODATA_OUT = -9999.0  # output nodata for GeoTIFFs (float32)
+INT16_SCALE = 0.01       # --out-dtype int16: value = stored * SCALE + OFFSET
+INT16_OFFSET = 0.0
+NODATA_INT16 = -32768
+SHARD_SIZE = 1024            # reference-grid pixels per worker task side (2 x 2 read windows)
+MAX_PENDING_PER_WORKER = 2  # shards in flight per pool worker
 
-# ---------------------- helpers ----------------------
+_DATE_T_RE = re.compile(r"(20\d{2})([01]\d)([0-3]\d)T")
+_DATE_SEP_RE = re.compile(r"(20\d{2})[-_]?([01]\d)[-_]?([0-3]\d)")
 
-def list_tiffs(root: Path, recursive: bool):
-    pats = ("*.tif", "*.tiff", "*.TIF", "*.TIFF")
-    files = []
-    it = root.rglob if recursive else root.glob
-    for p in pats:
-        files.extend(it(p))
-    return sorted(set(files))
+# ---------------------- helpers ----------------------
 
 def extract_date_from_name(name: str):
     """
@@ -47,70 +60,38 @@ def extract_date_from_name(name: str):
     Tries patterns like 20230712T..., 2023-07-12, 2023_07_12, 20230712.
     Returns datetime.date or None.
     """
-    # 1) YYYYMMDD followed by T
-    m = re.search(r"(20\d{2})([01]\d)([0-3]\d)T", name)
-    if m:
-        return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    # 1) YYYYMMDD followed by T. Fast path: the first 'T' (S1 names: ..._20230712T054512_...)
+    i = name.find("T", 8)
+    if i != -1:
+        d = name[i - 8:i]
+        if d.isascii() and d.isdigit() and d[:2] == "20" and d[4] in "01" and d[6] in "0123":
+            return date(int(d[:4]), int(d[4:6]), int(d[6:8]))
+        m = _DATE_T_RE.search(name, i + 1 - 8)
+        if m:
+            return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
     # 2) YYYY[-_]MM[-_]DD
-    m = re.search(r"(20\d{2})[-_]?([01]\d)[-_]?([0-3]\d)", name)
+    m = _DATE_SEP_RE.search(name)
     if m:
         return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
     return None
 
-def read_band_masked(ds, band_index):
-    """Read band as masked array honoring NoData & NaN/Inf."""
-    arr = ds.read(band_index, masked=False)
-    mask = ~np.isfinite(arr)
-    nd = ds.nodata
-    if nd is not None and not (isinstance(nd, float) and math.isnan(nd)):
-        mask |= (arr == nd)
-    return np.ma.MaskedArray(arr, mask=mask)
-
-def find_vv_vh_indices(ds, filepath: Path):
+def read_band_masked(ds, band_index, window=None):
     """
-    Return {'VV': idx_or_None, 'VH': idx_or_None}.
-    Priority: per-band descriptions/tags -> filename hint -> fallback [1,2].
+    Read band (or a window of it) as (float32 array, bool valid mask) honoring NoData.
+    NaN/Inf are not masked here: accumulate() skips non-finite values itself.
+    Band scale/offset are applied after the NoData test, as in reproject_window.
     """
-    vv = None
-    vh = None
-
-    # descriptions
-    if ds.descriptions:
-        for i, d in enumerate(ds.descriptions, start=1):
-            if not d:
-                continue
-            t = d.strip().upper()
-            if t == "VV" and vv is None:
-                vv = i
-            if t == "VH" and vh is None:
-                vh = i
-
-    # tags
-    for i in range(1, ds.count + 1):
-        tags = ds.tags(i)
-        for k in ("BAND_NAME", "name", "band_name", "long_name"):
-            v = tags.get(k)
-            if not v:
-                continue
-            t = v.strip().upper()
-            if t == "VV" and vv is None:
-                vv = i
-            if t == "VH" and vh is None:
-                vh = i
-
-    # filename hint for single-band
-    name = filepath.name.upper()
-    if ds.count == 1:
-        if "VV" in name and vv is None:
-            vv = 1
-        if "VH" in name and vh is None:
-            vh = 1
-
-    # fallback by position for 2-band products
-    if ds.count >= 2 and vv is None and vh is None:
-        vv, vh = 1, 2
-
-    return {"VV": vv, "VH": vh}
+    arr = ds.read(band_index, window=window, masked=False).astype("float32")
+    nd = ds.nodata
+    if nd is not None and not (isinstance(nd, float) and math.isnan(nd)):
+        valid = arr != nd
+    else:
+        valid = np.ones(arr.shape, dtype=bool)
+    scale, offset = ds.scales[band_index - 1], ds.offsets[band_index - 1]
+    if scale != 1.0 or offset != 0.0:
+        arr *= np.float32(scale)
+        arr += np.float32(offset)
+    return arr, valid
 
 def same_grid(ds, ref):
     return (
@@ -120,61 +101,108 @@ def same_grid(ds, ref):
         and ds.height == ref["height"]
     )
 
-def reproject_to_ref(data_ma, src_profile, ref):
+def open_geotiff(path: Path, ref, nodata=NODATA_OUT, dtype="float32"):
     """
-    Reproject masked array to reference grid.
-    Returns (data_float32, valid_mask_bool) in ref grid.
+    Open a single-band GeoTIFF on the ref grid for windowed writing.
+    int16 files carry INT16_SCALE/INT16_OFFSET as band scale/offset.
     """
-    src_data = data_ma.filled(np.nan).astype("float32")
-    src_valid = (~data_ma.mask).astype("uint8")
-
-    dst_h, dst_w = ref["height"], ref["width"]
-    dst_data = np.full((dst_h, dst_w), np.nan, dtype="float32")
-    dst_valid = np.zeros((dst_h, dst_w), dtype="uint8")
-
-    reproject(
-        source=src_data,
-        destination=dst_data,
-        src_transform=src_profile.transform,
-        src_crs=src_profile.crs,
-        dst_transform=ref["transform"],
-        dst_crs=ref["crs"],
-        resampling=Resampling.bilinear,
-        src_nodata=np.nan,
-        dst_nodata=np.nan,
-        num_threads=2,
-    )
-    reproject(
-        source=src_valid,
-        destination=dst_valid,
-        src_transform=src_profile.transform,
-        src_crs=src_profile.crs,
-        dst_transform=ref["transform"],
-        dst_crs=ref["crs"],
-        resampling=Resampling.nearest,
-        num_threads=2,
-    )
-    valid_bool = (dst_valid == 1) & np.isfinite(dst_data)
-    return dst_data, valid_bool
-
-def write_geotiff(path: Path, array, ref, nodata=NODATA_OUT):
     prof = {
         "driver": "GTiff",
         "width": ref["width"],
         "height": ref["height"],
         "count": 1,
-        "dtype": "float32",
+        "dtype": dtype,
         "crs": ref["crs"],
         "transform": ref["transform"],
         "nodata": nodata,
         "compress": "deflate",
+        "predictor": 3 if dtype == "float32" else 2,  # floating-point / horizontal differencing
+        "zlevel": 1,
+        "num_threads": "ALL_CPUS",
+        "BIGTIFF": "IF_SAFER",
         "tiled": True,
         "blockxsize": 256,
         "blockysize": 256,
     }
     path.parent.mkdir(parents=True, exist_ok=True)
-    with rasterio.open(path, "w", **prof) as dst:
-        dst.write(array.astype("float32"), 1)
+    dst = rasterio.open(path, "w", **prof)
+    if dtype == "int16":
+        dst.scales = (INT16_SCALE,)
+        dst.offsets = (INT16_OFFSET,)
+    return dst
+
+def quantize_int16(tile, valid):
+    """Pack float values as int16 (value = q * INT16_SCALE + INT16_OFFSET); NODATA_INT16 where invalid."""
+    q = np.rint((tile - INT16_OFFSET) / INT16_SCALE)
+    np.clip(q, NODATA_INT16 + 1, 32767, out=q)  # keep -32768 for NoData
+    q = q.astype("int16")
+    q[~valid] = NODATA_INT16
+    return q
+
+def accumulate_shard(scenes, ref, shard):
+    """
+    Accumulate every scene over one shard (a window of the reference grid).
+    Runs in a worker process; scenes is a list of (path, 'before'|'after').
+    Returns (windows, {(which, pol): [(sum_f32, count_u32) per window]},
+    {(which, pol): contributing scenes}).
+    """
+    windows = list(iter_windows(ref, region=shard))
+    acc = {}
+    used = {}
+    for tif, which in scenes:
+        with rasterio.open(tif) as ds:
+            idx = find_vv_vh_indices(ds, tif)
+
+            same = same_grid(ds, ref)
+            for pol in ("VV", "VH"):
+                b = idx.get(pol)
+                if not b or b > ds.count:
+                    continue
+
+                key = (which, pol)
+                if key not in acc:
+                    acc[key] = [(np.zeros((int(w.height), int(w.width)), dtype="float32"),
+                                 np.zeros((int(w.height), int(w.width)), dtype="float32"),
+                                 np.zeros((int(w.height), int(w.width)), dtype="uint32"))
+                                for w in windows]
+                    used[key] = 0
+                used[key] += 1
+
+                # Window by window: align to reference grid if needed, then Kahan-accumulate
+                for window, (sum_f32, comp_f32, cnt_u32) in zip(windows, acc[key]):
+                    if same:
+                        data, valid = read_band_masked(ds, b, window=window)
+                        valid = valid.view(np.uint8)
+                    else:
+                        data, valid = reproject_window(ds, b, ref, window)
+                    accumulate(sum_f32, comp_f32, cnt_u32, data, valid)
+
+    return windows, {key: [(t[0], t[2]) for t in tiles] for key, tiles in acc.items()}, used
+
+def reduce_shard(groups, total_used, ref, result):
+    """Copy one finished shard into the full-size sum/count arrays (in place)."""
+    windows, acc, used = result
+    for (which, pol), tiles in acc.items():
+        # Initialize accumulators
+        if groups[which][pol] is None:
+            groups[which][pol] = np.zeros((ref["height"], ref["width"]), dtype="float32")
+            groups[which]["count"][pol] = np.zeros((ref["height"], ref["width"]), dtype="uint32")
+
+        for win, (sum_f32, cnt_u32) in zip(windows, tiles):
+            rows, cols = win.toslices()
+            groups[which][pol][rows, cols] = sum_f32
+            groups[which]["count"][pol][rows, cols] = cnt_u32
+        # every shard sees the same scenes
+        total_used[which][pol] = used[(which, pol)]
+
+def _warmup(n_workers):
+    """
+    Pool initializer: shared rasterio.Env and numba kernels loaded before the first shard.
+    Kernels run single-threaded here; the pool provides the parallelism.
+    """
+    init_worker_env(n_workers)
+    numba.set_num_threads(1)
+    warmup_average_worker()
 
 # ---------------------- main ----------------------
 
@@ -183,36 +211,39 @@ def main():
     ap.add_argument("folder", type=str, help="Folder with S1 GRD GeoTIFFs (multi- or single-band).")
     ap.add_argument("--recursive", action="store_true", help="Recurse into subfolders.")
     ap.add_argument("--outdir", type=str, default=None, help="Output directory (default: <input>/averages)")
+    ap.add_argument("--out-dtype", choices=("float32", "int16"), default="float32",
+                    help="Output data type; int16 = 0.01 steps via scale/offset (for dB data)")
     args = ap.parse_args()
 
-    root = Path(args.folder)
-    outdir = Path(args.outdir) if args.outdir else (root / "averages")
-
-    files = list_tiffs(root, args.recursive)
-    if not files:
-        print(f"No GeoTIFFs found under {root}")
-        return
-
-    # Accumulators: for each polarization and group, keep sum & count arrays
-    groups = {
-        "before": {"VV": None, "VH": None, "count": {"VV": None, "VH": None}},
-        "after":  {"VV": None, "VH": None, "count": {"VV": None, "VH": None}},
-    }
-    # Reference grid (taken from first file encountered)
-    ref = None
-
-    total_used = {"before": {"VV": 0, "VH": 0}, "after": {"VV": 0, "VH": 0}}
-
-    for tif in files:
-        acq = extract_date_from_name(tif.name)
-        if acq is None:
-            print(f"[WARN] Skipping (no date in name): {tif.name}")
-            continue
-
-        which = "before" if acq < THRESHOLD else "after"
+    with rasterio.Env(**gdal_env()):
+        root = Path(args.folder)
+        outdir = Path(args.outdir) if args.outdir else (root / "averages")
+
+        files = list_tiffs(root, args.recursive)
+        if not files:
+            print(f"No GeoTIFFs found under {root}")
+            return
+
+        # Accumulators: for each polarization and group, keep sum & count arrays
+        # (the workers' Kahan compensation stays per shard)
+        groups = {
+            "before": {"VV": None, "VH": None, "count": {"VV": None, "VH": None}},
+            "after":  {"VV": None, "VH": None, "count": {"VV": None, "VH": None}},
+        }
+        total_used = {"before": {"VV": 0, "VH": 0}, "after": {"VV": 0, "VH": 0}}
+
+        scenes = []
+        for tif in files:
+            acq = extract_date_from_name(tif.name)
+            if acq is None:
+                print(f"[WARN] Skipping (no date in name): {tif.name}")
+                continue
+            scenes.append((tif, "before" if acq < THRESHOLD else "after"))
 
-        with rasterio.open(tif) as ds:
-            if ref is None:
+        # Reference grid (taken from first dated file), fixed before dispatching workers
+        ref = None
+        if scenes:
+            with rasterio.open(scenes[0][0]) as ds:
                 ref = {
                     "crs": ds.crs,
                     "transform": ds.transform,
@@ -220,55 +251,56 @@ def main():
                     "height": ds.height,
                 }
 
-            idx = find_vv_vh_indices(ds, tif)
-            for pol in ("VV", "VH"):
-                b = idx.get(pol)
-                if not b or b > ds.count:
-                    continue
-
-                band = read_band_masked(ds, b)
-
-                # Align to reference grid if needed
-                if same_grid(ds, ref):
-                    data = band.filled(np.nan).astype("float32")
-                    valid = (~band.mask) & np.isfinite(data)
-                else:
-                    data, valid = reproject_to_ref(band, ds.profile, ref)
-
-                # Initialize accumulators
-                if groups[which][pol] is None:
-                    groups[which][pol] = np.zeros((ref["height"], ref["width"]), dtype="float64")
-                    groups[which]["count"][pol] = np.zeros((ref["height"], ref["width"]), dtype="uint32")
-
-                groups[which][pol][valid] += data[valid].astype("float64")
-                groups[which]["count"][pol][valid] += 1
-                total_used[which][pol] += 1
-
-    # Write outputs
-    outputs = {
-        ("before", "VV"): outdir / "VV_before.tiff",
-        ("before", "VH"): outdir / "VH_before.tiff",
-        ("after",  "VV"): outdir / "VV_after.tiff",
-        ("after",  "VH"): outdir / "VH_after.tiff",
-    }
-
-    for (which, pol), path in outputs.items():
-        sum_arr = groups[which][pol]
-        cnt_arr = groups[which]["count"][pol]
-        if ref is None or sum_arr is None or cnt_arr is None or cnt_arr.max() == 0:
-            print(f"[INFO] No data for {pol} {which}; skipping {path.name}.")
-            continue
-
-        avg = np.full_like(sum_arr, NODATA_OUT, dtype="float32")
-        valid = cnt_arr > 0
-        avg[valid] = (sum_arr[valid] / cnt_arr[valid]).astype("float32")
-
-        write_geotiff(path, avg, ref, nodata=NODATA_OUT)
-        n_pix = int(valid.sum())
-        n_imgs = total_used[which][pol]
-        print(f"[OK] {path}  (contributing images: {n_imgs}, valid pixels: {n_pix})")
+        # Each worker accumulates all scenes over one shard of the reference grid
+        # (long-lived Env, kernels preloaded), so only the parent's sum/count arrays
+        # are full size. At most MAX_PENDING_PER_WORKER shards per worker are in flight,
+        # and each future is dropped once copied into the accumulators.
+        n_workers = os.cpu_count()
+        todo = iter_windows(ref, SHARD_SIZE) if ref is not None else iter(())
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_warmup,
+                                 initargs=(n_workers,)) as ex:
+            pending = {ex.submit(accumulate_shard, scenes, ref, shard)
+                       for shard in islice(todo, MAX_PENDING_PER_WORKER * n_workers)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    reduce_shard(groups, total_used, ref, fut.result())
+                pending |= {ex.submit(accumulate_shard, scenes, ref, shard)
+                            for shard in islice(todo, len(done))}
+                del done, fut
+
+        # Write outputs
+        outputs = {
+            ("before", "VV"): outdir / "VV_before.tiff",
+            ("before", "VH"): outdir / "VH_before.tiff",
+            ("after",  "VV"): outdir / "VV_after.tiff",
+            ("after",  "VH"): outdir / "VH_after.tiff",
+        }
+
+        for (which, pol), path in outputs.items():
+            sum_arr = groups[which][pol]
+            cnt_arr = groups[which]["count"][pol]
+            if ref is None or sum_arr is None or cnt_arr is None or cnt_arr.max() == 0:
+                print(f"[INFO] No data for {pol} {which}; skipping {path.name}.")
+                continue
 
-    print("Done.")
+            # Finalize the mean window by window straight into the output file
+            n_pix = 0
+            int16 = args.out_dtype == "int16"
+            nodata = NODATA_INT16 if int16 else NODATA_OUT
+            with open_geotiff(path, ref, nodata=nodata, dtype=args.out_dtype) as dst:
+                for win in iter_windows(ref):
+                    rows, cols = win.toslices()
+                    cnt = cnt_arr[rows, cols]
+                    valid = cnt > 0
+                    tile = np.full(cnt.shape, NODATA_OUT, dtype="float32")
+                    np.divide(sum_arr[rows, cols], cnt, out=tile, where=valid)
+                    dst.write(quantize_int16(tile, valid) if int16 else tile, 1, window=win)
+                    n_pix += int(valid.sum())
+            n_imgs = total_used[which][pol]
+            print(f"[OK] {path}  (contributing images: {n_imgs}, valid pixels: {n_pix})")
+
+        print("Done.")
 
 if __name__ == "__main__":
     main()
@@ -5,7 +5,9 @@ Visualize Sentinel-1 GRD VV/VH bands as PNGs with good-looking dB scaling.
 - Auto-detects VV/VH (from band descriptions/tags; falls back to band order or filename).
 - Converts linear backscatter to dB (10*log10) by default.
 - Robust contrast stretch with percentile clipping (default 2..98%).
-- Saves one PNG per band with a colorbar labeled in dB.
+- Saves one PNG per band (colormapped pixels, written directly with PIL) plus a single
+  colorbar legend PNG per run; --with-colorbar renders each band as a matplotlib figure
+  with its own dB colorbar and title instead.
 
 Usage example:
   python s1_visualize_vv_vh.py "s1_grd_VV-VH" \
@@ -22,127 +24,184 @@ Options:
   --fixed-range L H     Optional fixed dB range (e.g., -25 0) for consistent color scale across images
   --already-db          Skip dB conversion (use if your TIFFs are already in dB)
   --cmap NAME           Matplotlib colormap (default: gray). Try 'magma', 'viridis' if you prefer color.
-  --dpi N               PNG DPI (default: 180)
+  --dpi N               PNG DPI (default: 180; only used with --with-colorbar)
+  --with-colorbar       Render each PNG as a matplotlib figure with title and dB colorbar (slow)
 
 Requires:
   pip install rasterio numpy matplotlib
 """
 import argparse
 import math
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
 import numpy as np
 import rasterio
+from rasterio.enums import Resampling
+import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+from PIL import Image
+
+from _s1_utils import find_vv_vh_indices, gdal_env, init_worker_env, list_tiffs
 
 # ---------------- utilities ----------------
 
-def list_tiffs(root: Path, recursive: bool):
-    pats = ["*.tif", "*.tiff", "*.TIF", "*.TIFF"]
-    it = root.rglob if recursive else root.glob
-    files = []
-    for p in pats:
-        files.extend(it(p))
-    return sorted(set(files))
-
-def read_band_masked(ds, b):
-    """Read band b as masked array honoring nodata and NaN/Inf."""
-    arr = ds.read(b, masked=False)
-    mask = ~np.isfinite(arr)
+def read_band_masked(ds, b, out_shape=None):
+    """
+    Read band b as (array, bool valid mask) honoring nodata and NaN/Inf.
+    With out_shape, read decimated (GDAL serves it from the nearest overview).
+    Packed bands (scale/offset, e.g. int16 averages) are returned unpacked as float32.
+    """
+    arr = ds.read(b, out_shape=out_shape, resampling=Resampling.average, masked=False)
+    valid = np.isfinite(arr)
     nd = ds.nodata
     if nd is not None and not (isinstance(nd, float) and math.isnan(nd)):
-        mask |= (arr == nd)
-    return np.ma.MaskedArray(arr, mask=mask)
-
-def to_db_safe(ma):
-    """Convert linear backscatter to dB; <=0 becomes masked."""
-    m = np.ma.masked_less_equal(ma, 0)
-    with np.errstate(divide="ignore"):
-        return 10.0 * np.ma.log10(m)
-
-def robust_percentiles(ma, plo, phi, sample_max):
-    v = ma.compressed()
+        valid &= (arr != nd)
+    scale, offset = ds.scales[b - 1], ds.offsets[b - 1]
+    if scale != 1.0 or offset != 0.0:
+        arr = arr.astype("float32") * np.float32(scale) + np.float32(offset)
+    return arr, valid
+
+def to_db_safe(arr, valid):
+    """Convert linear backscatter to float32 dB; <=0 becomes invalid (NaN)."""
+    valid = valid & (arr > 0)
+    out = np.full(arr.shape, np.nan, dtype="float32")
+    np.log10(arr, out=out, where=valid)
+    out *= 10.0
+    return out, valid
+
+def band_to_db(band, valid, already_db):
+    """Return (float32 dB with NaN where invalid, valid)."""
+    if already_db:
+        return np.where(valid, band, np.nan).astype("float32"), valid
+    return to_db_safe(band, valid)
+
+def overview_shape(ds, b, sample_max):
+    """
+    Smallest overview shape (h, w) of band b that still holds >= sample_max pixels,
+    or None if there is none (percentiles then come from the full-resolution band).
+    """
+    best = None
+    for f in ds.overviews(b):
+        h, w = math.ceil(ds.height / f), math.ceil(ds.width / f)
+        if h * w >= sample_max and (best is None or h * w < best[0] * best[1]):
+            best = (h, w)
+    return best
+
+def robust_percentiles(arr, valid, plo, phi, sample_max):
+    v = arr[valid]
     if v.size == 0:
         return None, None
     if v.size > sample_max:
-        idx = np.random.default_rng(12345).choice(v.size, size=int(sample_max), replace=False)
+        # Sampling with replacement is fine for percentile estimation and avoids a permutation
+        idx = np.random.default_rng(12345).integers(0, v.size, size=int(sample_max))
         v = v[idx]
-    lo = np.percentile(v, plo)
-    hi = np.percentile(v, phi)
+    # One O(n) quickselect for both ranks instead of two full sorts
+    k_lo = int(plo / 100.0 * (v.size - 1))
+    k_hi = int(phi / 100.0 * (v.size - 1))
+    part = np.partition(v, [k_lo, k_hi])
+    lo, hi = part[k_lo], part[k_hi]
     if not np.isfinite(lo) or not np.isfinite(hi) or lo >= hi:
         lo, hi = float(v.min()), float(v.max())
     if lo == hi:
         hi = lo + 1e-6
     return float(lo), float(hi)
 
-def find_band_indices_for_vv_vh(ds, filepath: Path):
+def render_band_png(data_db, out_png: Path, vmin, vmax, cmap="gray", dpi=180, title=None,
+                    with_colorbar=False):
     """
-    Return dict like {'VV': index or None, 'VH': index or None}.
-    Priority: per-band descriptions/tags -> filename hint -> fallback by position.
+    Save a band image in dB (NaN pixels are transparent).
+    By default the colormapped pixels are written straight to PNG via PIL (no figure);
+    with_colorbar renders a matplotlib figure with title and dB colorbar.
     """
-    vv_idx = None
-    vh_idx = None
-
-    # 1) Descriptions
-    if ds.descriptions:
-        for i, d in enumerate(ds.descriptions, start=1):
-            if not d:
-                continue
-            t = d.strip().upper()
-            if t == "VV":
-                vv_idx = vv_idx or i
-            if t == "VH":
-                vh_idx = vh_idx or i
-
-    # 2) Tags
-    for i in range(1, ds.count + 1):
-        tags = ds.tags(i)
-        for k in ("BAND_NAME", "name", "band_name", "long_name"):
-            v = tags.get(k)
-            if not v:
-                continue
-            t = v.strip().upper()
-            if t == "VV":
-                vv_idx = vv_idx or i
-            if t == "VH":
-                vh_idx = vh_idx or i
-
-    # 3) Filename hint (single-band files commonly have VV/VH in name)
-    name = filepath.name.upper()
-    if ds.count == 1:
-        if "VV" in name and vv_idx is None:
-            vv_idx = 1
-        if "VH" in name and vh_idx is None:
-            vh_idx = 1
-
-    # 4) Fallback by position for two-band products
-    if ds.count >= 2:
-        if vv_idx is None and vh_idx is None:
-            # Many stacks are [VV, VH]
-            vv_idx, vh_idx = 1, 2
-
-    return {"VV": vv_idx, "VH": vh_idx}
-
-def render_band_png(ma_db, out_png: Path, vmin, vmax, cmap="gray", dpi=180, title=None):
-    """Save a band image with colorbar in dB."""
-    # Turn masked values transparent
-    img = np.ma.masked_invalid(ma_db)
-
-    plt.figure(figsize=(8, 6), dpi=dpi)
-    ax = plt.gca()
-    im = ax.imshow(img, vmin=vmin, vmax=vmax, cmap=cmap, interpolation="nearest")
-    ax.set_axis_off()
-    if title:
-        ax.set_title(title, fontsize=10)
-    cbar = plt.colorbar(im, ax=ax, fraction=0.030, pad=0.02)
-    cbar.set_label("Backscatter (dB)")
     out_png.parent.mkdir(parents=True, exist_ok=True)
-    plt.tight_layout(pad=0.05)
-    plt.savefig(out_png, bbox_inches="tight", pad_inches=0.05)
-    plt.close()
+    if with_colorbar:
+        plt.figure(figsize=(8, 6), dpi=dpi)
+        ax = plt.gca()
+        im = ax.imshow(data_db, vmin=vmin, vmax=vmax, cmap=cmap, interpolation="nearest")
+        ax.set_axis_off()
+        if title:
+            ax.set_title(title, fontsize=10)
+        cbar = plt.colorbar(im, ax=ax, fraction=0.030, pad=0.02)
+        cbar.set_label("Backscatter (dB)")
+        plt.tight_layout(pad=0.05)
+        plt.savefig(out_png, bbox_inches="tight", pad_inches=0.05)
+        plt.close()
+    else:
+        norm = (np.clip(data_db, vmin, vmax) - vmin) / (vmax - vmin)
+        rgba = plt.get_cmap(cmap)(norm, bytes=True)  # NaN -> colormap "bad" colour (transparent)
+        Image.fromarray(rgba).save(out_png, optimize=False, compress_level=1)
     print(f"[OK] {out_png}  (dB range {vmin:.2f}..{vmax:.2f})")
 
+def write_colorbar_png(out_png: Path, vmin, vmax, cmap, label, ticklabels=None):
+    """Save a standalone horizontal colorbar legend."""
+    out_png.parent.mkdir(parents=True, exist_ok=True)
+    fig, ax = plt.subplots(figsize=(4, 0.5), dpi=180)
+    cbar = fig.colorbar(ScalarMappable(norm=Normalize(vmin, vmax), cmap=cmap), cax=ax,
+                        orientation="horizontal")
+    cbar.set_label(label)
+    if ticklabels:
+        cbar.set_ticks([vmin, vmax], labels=ticklabels)
+    fig.savefig(out_png, bbox_inches="tight", pad_inches=0.05)
+    plt.close(fig)
+
+def _init_worker(n_workers):
+    """Headless matplotlib backend and one shared rasterio.Env per worker process."""
+    matplotlib.use("Agg")
+    init_worker_env(n_workers)
+
+def render_one(tif: Path, args_dict, out_root: Path):
+    """Render the VV/VH PNGs of one GeoTIFF (runs in a worker process)."""
+    args = argparse.Namespace(**args_dict)
+    with rasterio.open(tif) as ds:
+        idx = find_vv_vh_indices(ds, tif)
+        file_out_dir = out_root / tif.stem
+
+        for pol in ("VV", "VH"):
+            b = idx.get(pol)
+            if not b or b > ds.count:
+                # Not present in this file
+                continue
+
+            band, valid = read_band_masked(ds, b)
+
+            # Convert to dB if needed
+            data_db, valid = band_to_db(band, valid, args.already_db)
+
+            # Determine display range in dB
+            if args.fixed_range:
+                vmin, vmax = float(args.fixed_range[0]), float(args.fixed_range[1])
+            else:
+                # Sample percentiles from an overview near --sample pixels when the file has one
+                shape = overview_shape(ds, b, args.sample)
+                if shape is None:
+                    stats_db, stats_valid = data_db, valid
+                else:
+                    stats_db, stats_valid = band_to_db(*read_band_masked(ds, b, out_shape=shape),
+                                                       args.already_db)
+                vmin, vmax = robust_percentiles(stats_db, stats_valid, args.pclip[0], args.pclip[1], args.sample)
+                if vmin is None:
+                    print(f"[SKIP] {tif.name} {pol}: no valid data.")
+                    continue
+                # Clamp to a sensible SAR range to avoid wild outliers
+                vmin = max(vmin, -35.0)
+                vmax = min(vmax, 5.0)
+                if vmin >= vmax:
+                    vmax = vmin + 0.1
+
+            # Title & output
+            title = f"{tif.name} — {pol}"
+            out_png = file_out_dir / f"{tif.stem}_{pol}_dB.png"
+
+            render_band_png(data_db, out_png, vmin=vmin, vmax=vmax,
+                            cmap=args.cmap, dpi=args.dpi, title=title,
+                            with_colorbar=args.with_colorbar)
+
 # ---------------- main ----------------
 
 def main():
@@ -158,60 +217,41 @@ def main():
     ap.add_argument("--already-db", action="store_true",
                     help="Skip dB conversion (use if your data are already in dB)")
     ap.add_argument("--cmap", type=str, default="gray", help="Matplotlib colormap (default: gray)")
-    ap.add_argument("--dpi", type=int, default=180, help="DPI for PNGs")
+    ap.add_argument("--dpi", type=int, default=180, help="DPI for PNGs (only with --with-colorbar)")
+    ap.add_argument("--with-colorbar", action="store_true",
+                    help="Render each PNG as a matplotlib figure with title and colorbar (slow)")
     args = ap.parse_args()
 
-    root = Path(args.folder)
-    out_root = Path(args.outdir) if args.outdir else (root / "png")
-
-    files = list_tiffs(root, args.recursive)
-    if not files:
-        print(f"No GeoTIFFs found under {root}")
-        return
-
-    print(f"Found {len(files)} file(s). Writing PNGs under: {out_root}")
-
-    for tif in files:
-        with rasterio.open(tif) as ds:
-            idx = find_band_indices_for_vv_vh(ds, tif)
-            file_out_dir = out_root / tif.stem
-
-            for pol in ("VV", "VH"):
-                b = idx.get(pol)
-                if not b or b > ds.count:
-                    # Not present in this file
-                    continue
-
-                band = read_band_masked(ds, b)
-
-                # Convert to dB if needed
-                if args.already_db:
-                    data_db = band.astype("float32")
-                else:
-                    data_db = to_db_safe(band).astype("float32")
-
-                # Determine display range in dB
-                if args.fixed_range:
-                    vmin, vmax = float(args.fixed_range[0]), float(args.fixed_range[1])
-                else:
-                    vmin, vmax = robust_percentiles(data_db, args.pclip[0], args.pclip[1], args.sample)
-                    if vmin is None:
-                        print(f"[SKIP] {tif.name} {pol}: no valid data.")
-                        continue
-                    # Clamp to a sensible SAR range to avoid wild outliers
-                    vmin = max(vmin, -35.0)
-                    vmax = min(vmax, 5.0)
-                    if vmin >= vmax:
-                        vmax = vmin + 0.1
-
-                # Title & output
-                title = f"{tif.name} — {pol}"
-                out_png = file_out_dir / f"{tif.stem}_{pol}_dB.png"
-
-                render_band_png(data_db, out_png, vmin=vmin, vmax=vmax,
-                                cmap=args.cmap, dpi=args.dpi, title=title)
-
-    print("Done.")
+    with rasterio.Env(**gdal_env()):
+        root = Path(args.folder)
+        out_root = Path(args.outdir) if args.outdir else (root / "png")
+
+        files = list_tiffs(root, args.recursive)
+        if not files:
+            print(f"No GeoTIFFs found under {root}")
+            return
+
+        print(f"Found {len(files)} file(s). Writing PNGs under: {out_root}")
+
+        # One shared legend per run instead of a colorbar in every image
+        if not args.with_colorbar:
+            legend_png = out_root / f"colorbar_{args.cmap}.png"
+            if args.fixed_range:
+                write_colorbar_png(legend_png, float(args.fixed_range[0]), float(args.fixed_range[1]),
+                                   args.cmap, "Backscatter (dB)")
+            else:
+                write_colorbar_png(legend_png, 0.0, 1.0, args.cmap,
+                                   "Backscatter (dB), per-image stretch (range in log)",
+                                   ticklabels=(f"p{args.pclip[0]:g}", f"p{args.pclip[1]:g}"))
+            print(f"[OK] {legend_png}  (legend)")
+
+        # Files are independent: render them in parallel, one file per task (each takes seconds)
+        n_workers = os.cpu_count()
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(n_workers,)) as ex:
+            list(ex.map(render_one, files, repeat(vars(args)), repeat(out_root)))
+
+        print("Done.")
 
 if __name__ == "__main__":
     main()
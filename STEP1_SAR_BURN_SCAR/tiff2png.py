@@ -5,24 +5,36 @@ from pathlib import Path
 import numpy as np
 import rasterio
 import matplotlib.pyplot as plt
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+from PIL import Image
+
+from _s1_utils import gdal_env
 
 def read_band_masked(path: Path):
     with rasterio.open(path) as ds:
         arr = ds.read(1, masked=False)
         nd  = ds.nodata
-        mask = ~np.isfinite(arr)
+        valid = np.isfinite(arr)
         if nd is not None and not (isinstance(nd, float) and math.isnan(nd)):
-            mask |= (arr == nd)
-    return np.ma.MaskedArray(arr, mask=mask)
+            valid &= (arr != nd)
+        scale, offset = ds.scales[0], ds.offsets[0]  # unpack e.g. int16 averages
+        if scale != 1.0 or offset != 0.0:
+            arr = arr.astype("float32") * np.float32(scale) + np.float32(offset)
+    return arr, valid
 
-def to_db(ma):
-    m = np.ma.masked_less_equal(ma, 0)
-    with np.errstate(divide="ignore"): return 10.0 * np.ma.log10(m)
+def to_db(arr, valid):
+    valid = valid & (arr > 0)
+    out = np.full(arr.shape, np.nan, dtype="float32")
+    np.log10(arr, out=out, where=valid); out *= 10.0
+    return out, valid
 
-def percentiles(ma, lo, hi):
-    v = ma.compressed()
+def percentiles(arr, valid, lo, hi):
+    v = arr[valid]
     if v.size == 0: return None, None
-    return float(np.percentile(v, lo)), float(np.percentile(v, hi))
+    k_lo, k_hi = int(lo / 100.0 * (v.size - 1)), int(hi / 100.0 * (v.size - 1))
+    part = np.partition(v, [k_lo, k_hi])  # O(n) quickselect, no full sort
+    return float(part[k_lo]), float(part[k_hi])
 
 def main():
     ap = argparse.ArgumentParser(description="Plot a GeoTIFF (band 1) as a nice PNG.")
@@ -34,36 +46,51 @@ def main():
     ap.add_argument("--fixed-range", nargs=2, type=float, metavar=("MIN","MAX"),
                     help="Fixed display range (skips percentile stretch)")
     ap.add_argument("--cmap", default="gray", help="Matplotlib colormap (default: gray)")
-    ap.add_argument("--dpi", type=int, default=180, help="PNG DPI (default 180)")
+    ap.add_argument("--dpi", type=int, default=180, help="PNG DPI (default 180, only with --with-colorbar)")
+    ap.add_argument("--with-colorbar", action="store_true",
+                    help="Render a matplotlib figure with title and colorbar (default: raw pixels + legend PNG)")
     args = ap.parse_args()
 
-    tif = Path(args.tif)
-    out = Path(args.out) if args.out else tif.with_suffix(".png")
-    title = tif.stem
+    with rasterio.Env(**gdal_env()):
+        tif = Path(args.tif)
+        out = Path(args.out) if args.out else tif.with_suffix(".png")
+        title = tif.stem
 
-    band = read_band_masked(tif)
-    data = to_db(band) if args.db else band
+        band, valid = read_band_masked(tif)
+        data, valid = to_db(band, valid) if args.db else (band, valid)
 
-    if args.fixed_range:
-        vmin, vmax = map(float, args.fixed_range)
-    else:
-        vmin, vmax = percentiles(data, *args.pclip)
-        if vmin is None:
-            print("No valid data to plot."); return
-        if vmin >= vmax: vmax = vmin + 1e-6
+        if args.fixed_range:
+            vmin, vmax = map(float, args.fixed_range)
+        else:
+            vmin, vmax = percentiles(data, valid, *args.pclip)
+            if vmin is None:
+                print("No valid data to plot."); return
+            if vmin >= vmax: vmax = vmin + 1e-6
 
-    plt.figure(figsize=(8,6), dpi=args.dpi)
-    ax = plt.gca()
-    im = ax.imshow(data, vmin=vmin, vmax=vmax, cmap=args.cmap, interpolation="nearest")
-    ax.set_title(title, fontsize=11)
-    ax.set_axis_off()
-    cbar = plt.colorbar(im, ax=ax, fraction=0.03, pad=0.02)
-    cbar.set_label("Value (dB)" if args.db else "Value")
-    out.parent.mkdir(parents=True, exist_ok=True)
-    plt.tight_layout(pad=0.05)
-    plt.savefig(out, bbox_inches="tight", pad_inches=0.05)
-    plt.close()
-    print(f"[OK] {out}  range={vmin:.4f}..{vmax:.4f}")
+        img = np.where(valid, data, np.nan)
+        label = "Value (dB)" if args.db else "Value"
+        out.parent.mkdir(parents=True, exist_ok=True)
+        if args.with_colorbar:
+            plt.figure(figsize=(8,6), dpi=args.dpi)
+            ax = plt.gca()
+            im = ax.imshow(img, vmin=vmin, vmax=vmax, cmap=args.cmap, interpolation="nearest")
+            ax.set_title(title, fontsize=11)
+            ax.set_axis_off()
+            cbar = plt.colorbar(im, ax=ax, fraction=0.03, pad=0.02)
+            cbar.set_label(label)
+            plt.tight_layout(pad=0.05)
+            plt.savefig(out, bbox_inches="tight", pad_inches=0.05)
+            plt.close()
+        else:
+            # Colormapped pixels straight to PNG (NaN -> transparent), legend as a separate PNG
+            norm = (np.clip(img, vmin, vmax) - vmin) / (vmax - vmin)
+            Image.fromarray(plt.get_cmap(args.cmap)(norm, bytes=True)).save(out, optimize=False, compress_level=1)
+            fig, ax = plt.subplots(figsize=(4,0.5), dpi=180)
+            fig.colorbar(ScalarMappable(norm=Normalize(vmin, vmax), cmap=args.cmap), cax=ax,
+                         orientation="horizontal").set_label(label)
+            fig.savefig(out.with_name(f"{out.stem}_colorbar.png"), bbox_inches="tight", pad_inches=0.05)
+            plt.close(fig)
+        print(f"[OK] {out}  range={vmin:.4f}..{vmax:.4f}")
 
 if __name__ == "__main__":
     main()